@@ -103,7 +103,7 @@ class Evaluator:
         """
         storer = defaultdict(list)
         for data, _ in tqdm(dataloader, leave=False, disable=not self.is_progress_bar):
-            data = data.to(self.device)
+            data = data.to(self.device, non_blocking=True)
 
             try:
                 recon_batch, latent_dist, latent_sample = self.model(data)
@@ -222,7 +222,7 @@ class Evaluator:
             for x, label in dataloader:
                 batch_size = x.size(0)
                 idcs = slice(n, n + batch_size)
-                q_zCx[idcs, :, 0], q_zCx[idcs, :, 1] = self.model.encoder(x.to(self.device))
+                q_zCx[idcs, :, 0], q_zCx[idcs, :, 1] = self.model.encoder(x.to(self.device, non_blocking=True))
                 n += batch_size
 
         params_zCX = q_zCx.unbind(-1)
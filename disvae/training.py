@@ -147,7 +147,7 @@ class Trainer():
             Dictionary in which to store important variables for vizualisation.
         """
         batch_size, channel, height, width = data.size()
-        data = data.to(self.device)
+        data = data.to(self.device, non_blocking=True)
 
         try:
             recon_batch, latent_dist, latent_sample = self.model(data)
@@ -1,6 +1,5 @@
 import json
 import os
-import re
 
 import numpy as np
 import torch
@@ -118,9 +117,10 @@ def load_checkpoints(directory, is_gpu=True):
     checkpoints = []
     for root, _, filenames in os.walk(directory):
         for filename in filenames:
-            results = re.search(r'.*?-([0-9].*?).pt', filename)
-            if results is not None:
-                epoch_idx = int(results.group(1))
+            name, extension = os.path.splitext(filename)
+            epoch_idx = name.rpartition("-")[2]
+            if extension == ".pt" and epoch_idx.isdigit():
+                epoch_idx = int(epoch_idx)
                 model = load_model(root, is_gpu=is_gpu, filename=filename)
                 checkpoints.append((epoch_idx, model))
 
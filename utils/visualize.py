@@ -1,5 +1,5 @@
 import os
-from math import ceil, floor
+from contextlib import contextmanager
 
 import imageio
 from PIL import Image
@@ -7,8 +7,7 @@ import numpy as np
 from scipy import stats
 import torch
 import torch.nn.functional as F
-from torch.autograd import Variable
-from torchvision.utils import make_grid, save_image
+from torchvision.utils import save_image
 
 from utils.datasets import get_background
 from utils.viz_helpers import (read_loss_from_file, add_labels, make_grid_img,
@@ -25,6 +24,17 @@ PLOT_NAMES = dict(generate_samples="samples.png",
                   gif_traversals="posterior_traversals.gif",)
 
 
+@contextmanager
+def _eval_mode(model):
+    """Temporarily put the model in evaluation mode, restoring its mode on exit."""
+    is_training = model.training
+    model.eval()
+    try:
+        yield
+    finally:
+        model.train(is_training)
+
+
 class Visualizer():
     def __init__(self, model, dataset, model_dir,
                  save_images=True,
@@ -71,6 +81,7 @@ class Visualizer():
         self.model = model
         self.device = next(self.model.parameters()).device
         self.latent_dim = self.model.latent_dim
+        self.img_size = tuple(self.model.img_size)
         self.max_traversal = max_traversal
         self.save_images = save_images
         self.model_dir = model_dir
@@ -79,6 +90,8 @@ class Visualizer():
         if loss_of_interest is not None:
             self.losses = read_loss_from_file(os.path.join(self.model_dir, TRAIN_FILE),
                                               loss_of_interest)
+            # latent dimensions by decreasing loss, shared by all reordered plots
+            self.latent_order = sort_list_by_other(range(self.latent_dim), self.losses)
 
     def _get_traversal_range(self, mean=0, std=1):
         """Return the corresponding traversal range in absolute terms."""
@@ -91,19 +104,16 @@ class Visualizer():
         # symmetrical traversals
         return (-1 * max_traversal, max_traversal)
 
-    def _traverse_line(self, idx, n_samples, data=None):
-        """Return a (size, latent_size) latent sample, corresponding to a traversal
-        of a latent variable indicated by idx.
+    def _traverse_lines(self, n_samples, data=None):
+        """Return a (latent_size * n_samples, latent_size) latent sample, corresponding
+        to a traversal of every latent variable one after the other. Rows
+        `idx * n_samples` to `(idx + 1) * n_samples` traverse the latent variable
+        indicated by idx while all others are fixed.
 
         Parameters
         ----------
-        idx : int
-            Index of continuous dimension to traverse. If the continuous latent
-            vector is 10 dimensional and idx = 7, then the 7th dimension
-            will be traversed while all others are fixed.
-
         n_samples : int
-            Number of samples to generate.
+            Number of samples to generate per latent variable.
 
         data : torch.Tensor or None, optional
             Data to use for computing the posterior. Shape (N, C, H, W). If
@@ -111,33 +121,37 @@ class Visualizer():
         """
         if data is None:
             # mean of prior for other dimensions
-            samples = torch.zeros(n_samples, self.latent_dim)
-            traversals = torch.linspace(*self._get_traversal_range(), steps=n_samples)
+            samples = torch.zeros(self.latent_dim)
+            mean, std = 0, 1
 
         else:
             if data.size(0) > 1:
                 raise ValueError("Every value should be sampled from the same posterior, but {} datapoints given.".format(data.size(0)))
 
-            with torch.no_grad():
+            with torch.inference_mode():
                 post_mean, post_logvar = self.model.encoder(data.to(self.device))
-                samples = self.model.reparameterize(post_mean, post_logvar)
-                samples = samples.cpu().repeat(n_samples, 1)
-                post_mean_idx = post_mean.cpu()[0, idx]
-                post_std_idx = torch.exp(post_logvar / 2).cpu()[0, idx]
+                samples = self.model.reparameterize(post_mean, post_logvar).cpu()[0]
+                mean = post_mean.cpu()[0].numpy()
+                std = torch.exp(post_logvar / 2).cpu()[0].numpy()
 
-            # travers from the gaussian of the posterior in case quantile
-            traversals = torch.linspace(*self._get_traversal_range(mean=post_mean_idx,
-                                                                   std=post_std_idx),
-                                        steps=n_samples)
+        # travers from the gaussian of the posterior in case quantile
+        lower, upper = self._get_traversal_range(mean=mean, std=std)
+        traversals = np.linspace(np.broadcast_to(lower, self.latent_dim),
+                                 np.broadcast_to(upper, self.latent_dim),
+                                 num=n_samples, axis=-1)
 
-        for i in range(n_samples):
-            samples[i, idx] = traversals[i]
+        # shape (latent_size, n_samples, latent_size): the traversed values are
+        # where the first and last indices are equal
+        samples = samples.repeat(self.latent_dim, n_samples, 1)
+        idcs = torch.arange(self.latent_dim)
+        samples[idcs, :, idcs] = torch.from_numpy(traversals).float()
 
-        return samples
+        return samples.view(-1, self.latent_dim)
 
     def _save_or_return(self, to_plot, size, filename, is_force_return=False):
         """Create plot and save or return it."""
-        to_plot = F.interpolate(to_plot, scale_factor=self.upsample_factor)
+        if self.upsample_factor != 1:
+            to_plot = F.interpolate(to_plot, scale_factor=self.upsample_factor)
 
         if size[0] * size[1] != to_plot.shape[0]:
             raise ValueError("Wrong size {} for datashape {}".format(size, to_plot.shape))
@@ -155,12 +169,15 @@ class Visualizer():
 
         Parameters
         ----------
-        latent_samples : torch.autograd.Variable
+        latent_samples : torch.Tensor
             Samples from latent distribution. Shape (N, L) where L is dimension
             of latent distribution.
         """
         latent_samples = latent_samples.to(self.device)
-        return self.model.decoder(latent_samples).cpu()
+        # half precision is enough for 8 bit images but only worth it on GPU
+        is_autocast = self.device.type == "cuda"
+        with torch.inference_mode(), torch.autocast(self.device.type, enabled=is_autocast):
+            return self.model.decoder(latent_samples).float()
 
     def generate_samples(self, size=(8, 8)):
         """Plot generated samples from the prior and decoding.
@@ -170,9 +187,9 @@ class Visualizer():
         size : tuple of ints, optional
             Size of the final grid.
         """
-        prior_samples = torch.randn(size[0] * size[1], self.latent_dim)
+        prior_samples = torch.randn(size[0] * size[1], self.latent_dim, device=self.device)
         generated = self._decode_latents(prior_samples)
-        return self._save_or_return(generated.data, size, PLOT_NAMES["generate_samples"])
+        return self._save_or_return(generated, size, PLOT_NAMES["generate_samples"])
 
     def data_samples(self, data, size=(8, 8)):
         """Plot samples from the dataset
@@ -214,12 +231,11 @@ class Visualizer():
         else:
             n_samples = size[0] * size[1]
 
-        with torch.no_grad():
-            originals = data.to(self.device)[:n_samples, ...]
+        with torch.inference_mode():
+            originals = data[:n_samples, ...].to(self.device)
             recs, _, _ = self.model(originals)
 
-        originals = originals.cpu()
-        recs = recs.view(-1, *self.model.img_size).cpu()
+        recs = recs.view(-1, *self.img_size)
 
         to_plot = torch.cat([originals, recs]) if is_original else recs
         return self._save_or_return(to_plot, size, PLOT_NAMES["reconstruct"],
@@ -255,26 +271,25 @@ class Visualizer():
         is_force_return : bool, optional
             Force returning instead of saving the image.
         """
-        n_latents = n_latents if n_latents is not None else self.model.latent_dim
-        latent_samples = [self._traverse_line(dim, n_per_latent, data=data)
-                          for dim in range(self.latent_dim)]
-        decoded_traversal = self._decode_latents(torch.cat(latent_samples, dim=0))
+        n_latents = n_latents if n_latents is not None else self.latent_dim
+        latent_samples = self._traverse_lines(n_per_latent, data=data)
+        decoded_traversal = self._decode_latents(latent_samples)
 
         if is_reorder_latents:
             n_images, *other_shape = decoded_traversal.size()
             n_rows = n_images // n_per_latent
-            decoded_traversal = decoded_traversal.reshape(n_rows, n_per_latent, *other_shape)
-            decoded_traversal = sort_list_by_other(decoded_traversal, self.losses)
-            decoded_traversal = torch.stack(decoded_traversal, dim=0)
-            decoded_traversal = decoded_traversal.reshape(n_images, *other_shape)
+            row_order = torch.as_tensor(self.latent_order, device=decoded_traversal.device)
+            decoded_traversal = decoded_traversal.view(n_rows, n_per_latent, *other_shape)
+            decoded_traversal = decoded_traversal.index_select(0, row_order)
+            decoded_traversal = decoded_traversal.view(n_images, *other_shape)
 
-        decoded_traversal = decoded_traversal[range(n_per_latent * n_latents), ...]
+        decoded_traversal = decoded_traversal[:n_per_latent * n_latents, ...]
 
         size = (n_latents, n_per_latent)
         sampling_type = "prior" if data is None else "posterior"
         filename = "{}_{}".format(sampling_type, PLOT_NAMES["traversals"])
 
-        return self._save_or_return(decoded_traversal.data, size, filename,
+        return self._save_or_return(decoded_traversal, size, filename,
                                     is_force_return=is_force_return)
 
     def reconstruct_traverse(self, data,
@@ -306,7 +321,7 @@ class Visualizer():
         is_show_text : bool, optional
             Whether the KL values next to the traversal rows.
         """
-        n_latents = n_latents if n_latents is not None else self.model.latent_dim
+        n_latents = n_latents if n_latents is not None else self.latent_dim
 
         reconstructions = self.reconstruct(data[:2 * n_per_latent, ...],
                                            size=(2, n_per_latent),
@@ -321,7 +336,7 @@ class Visualizer():
         concatenated = Image.fromarray(concatenated)
 
         if is_show_text:
-            losses = sorted(self.losses, reverse=True)[:n_latents]
+            losses = [self.losses[dim] for dim in self.latent_order[:n_latents]]
             labels = ['orig', 'recon'] + ["KL={:.4f}".format(l) for l in losses]
             concatenated = add_labels(concatenated, labels)
 
@@ -347,19 +362,20 @@ class Visualizer():
         """
         n_images, _, _, width_col = data.shape
         width_col = int(width_col * self.upsample_factor)
-        all_cols = [[] for c in range(n_per_gif)]
-        for i in range(n_images):
-            grid = self.traversals(data=data[i:i + 1, ...], is_reorder_latents=True,
-                                   n_per_latent=n_per_gif, n_latents=n_latents,
-                                   is_force_return=True)
+        grids = np.stack([self.traversals(data=data[i:i + 1, ...], is_reorder_latents=True,
+                                          n_per_latent=n_per_gif, n_latents=n_latents,
+                                          is_force_return=True)
+                          for i in range(n_images)], axis=0)
 
-            height, width, c = grid.shape
-            padding_width = (width - width_col * n_per_gif) // (n_per_gif + 1)
+        _, height, width, c = grids.shape
+        padding_width = (width - width_col * n_per_gif) // (n_per_gif + 1)
 
-            # split the grids into a list of column images (and removes padding)
-            for j in range(n_per_gif):
-                all_cols[j].append(grid[:, [(j + 1) * padding_width + j * width_col + i
-                                            for i in range(width_col)], :])
+        # split the grids into column images (and removes padding) using a single
+        # reshape. Shape (n_per_gif, n_images, height, width_col, c)
+        step = padding_width + width_col
+        all_cols = grids[:, :, padding_width:padding_width + n_per_gif * step, :]
+        all_cols = all_cols.reshape(n_images, height, n_per_gif, step, c)[..., :width_col, :]
+        all_cols = all_cols.transpose(2, 0, 1, 3, 4)
 
         pad_values = (1 - get_background(self.dataset)) * 255
         all_cols = [concatenate_pad(cols, pad_size=2, pad_values=pad_values, axis=1)
@@ -414,15 +430,12 @@ class GifTraversalsTraining:
 
     def __call__(self):
         """Generate the next gif image. Should be called after each epoch."""
-        cached_training = self.visualizer.model.training
-        self.visualizer.model.eval()
-        img_grid = self.visualizer.traversals(data=None,  # GIF from prior
-                                              is_reorder_latents=self.is_reorder_latents,
-                                              n_per_latent=self.n_per_latent,
-                                              n_latents=self.n_latents)
+        with _eval_mode(self.visualizer.model):
+            img_grid = self.visualizer.traversals(data=None,  # GIF from prior
+                                                  is_reorder_latents=self.is_reorder_latents,
+                                                  n_per_latent=self.n_per_latent,
+                                                  n_latents=self.n_latents)
         self.images.append(img_grid)
-        if cached_training:
-            self.visualizer.model.train()
 
     def save_reset(self):
         """Saves the GIF and resets the list of images. Call at the end of training."""